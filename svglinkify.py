@@ -1,12 +1,69 @@
 #!/usr/bin/env python
 
 import sys
+import bisect
 import collections
 import tempfile
 import re
+import os
 import shutil
+import xml.etree.ElementTree as ET
 from subprocess import Popen, PIPE
 
+try:
+    # RE2 guarantees linear time matching which matters for the patterns run
+    # over the whole QDF. Patterns compiled with it must only use inline flags
+    # and numbered groups to stay compatible with both engines.
+    import re2 as fast_re
+except ImportError:
+    fast_re = re
+
+# SVG patterns
+
+_SVG_LENGTH_RE = re.compile(r"\s*([0-9.]+)(px|pt|mm|pc|cm|in)?\s*$")
+_SVG_VIEWBOX_RE = re.compile(r"\s*([0-9.]+)\s+([0-9.]+)\s+([0-9.]+)\s+([0-9.]+)\s*$")
+
+# SVG element and attribute names
+
+_SVG_TAG = "{http://www.w3.org/2000/svg}svg"
+_ANCHOR_TAG = "{http://www.w3.org/2000/svg}a"
+_PAGE_TAG = "{http://www.inkscape.org/namespaces/inkscape}page"
+_XLINK_HREF_ATTR = "{http://www.w3.org/1999/xlink}href"
+
+# Inkscape shell output patterns
+
+_QUERY_ROW_RE = re.compile(
+    r"^(?:> )*([^,\s]+),([0-9.]+),([0-9.]+),([0-9.]+),([0-9.]+)$", re.MULTILINE
+)
+
+# QDF patterns
+
+# Groups: page number, object ID, object generation, object body
+_QDF_PAGE_OBJ_RE = fast_re.compile(
+    rb"(?ms)^%% Page (\d+)\n%%[^\n]*\n(\d+) (\d+) obj\n(.*?)^endobj$"
+)
+_QDF_ANNOTS_RE = fast_re.compile(rb"/Annots\s+\[([^\]]+)\]")
+_QDF_TRAILER_SIZE_RE = re.compile(rb"/Size \d+")
+_QDF_REF_RE = re.compile(rb"(\d+)\s+(\d+)\s+R\b")
+
+# Characters that would need escaping in the PDF literal string holding a URI
+# are percent-encoded instead.
+
+_URI_ESCAPE_RE = re.compile(rb"[()\\]")
+_URI_ESCAPES = {b"(": b"%28", b")": b"%29", b"\\": b"%5C"}
+
+# Link annotation object. The action is filled in once per link, leaving the
+# object ID and the rectangle to be formatted per annotation. The object starts
+# right at its header so its xref offset is where it is inserted.
+
+_ANNOT_OBJ_TEMPLATE = (
+    b"%d 0 obj\n"
+    b"<<\n  /Type /Annot /Subtype /Link /Border [ 0 0 0 ]"
+    b" /A << /S %s >>"
+    b" /Rect [ %f %f %f %f ]\n>>\n"
+    b"endobj\n\n"
+)
+
 
 class Error(Exception):
     pass
@@ -23,27 +80,146 @@ def intersected(a, b):
     return True
 
 
-def main():
+def page_intersections(pages, objects):
+    """
+    Yields (obj, obj_pages) for every object, where obj_pages is the list of
+    pages intersecting obj ordered by page number.
+    """
+    pages = sorted(pages.values(), key=lambda p: p["number"])
+    if len(pages) < 8:
+        for obj in objects:
+            yield obj, [p for p in pages if intersected(p, obj)]
+        return
+
+    # Sweep objects left to right, keeping the set of pages whose x range is
+    # still active. A page that ends before the current object starts can't
+    # overlap any of the following objects either.
+    by_x = sorted(pages, key=lambda p: p["x"])
+    starts = [p["x"] for p in by_x]
+    added = 0
+    active = []
+    for obj in sorted(objects, key=lambda o: o["x"]):
+        x1, x2 = obj["x"], obj["x"] + obj["w"]
+        end = bisect.bisect_right(starts, x2)
+        if end > added:
+            active.extend(by_x[added:end])
+            added = end
+        active = [p for p in active if p["x"] + p["w"] >= x1]
+        yield obj, sorted(
+            (p for p in active if intersected(p, obj)),
+            key=lambda p: p["number"],
+        )
 
-    # Check requirements
 
-    qpdf_path = shutil.which("qpdf")
-    fix_qdf_path = shutil.which("fix-qdf")
-    if not qpdf_path or not fix_qdf_path:
-        raise Error("qpdf is missing - please install it before retrying")
-    inkscape_path = shutil.which("inkscape")
-    if not inkscape_path:
-        raise Error("inkscape is missing - please install it before retrying")
-    if len(sys.argv) < 3:
-        raise Error(
-            "Usage: %s input.svg output.pdf [inkscape cli flags ...]" % sys.argv[0]
-        )
-    input_svg_path, output_pdf_path, *inkscape_flags = sys.argv[1:]
+def link_annot_object_ids(qdf_content):
+    """
+    Returns the set of (object ID, generation) of all link annotations in the
+    QDF content. Only the spots around each "/Subtype /Link" are looked at,
+    instead of every object in the document.
+    """
+    ids = set()
+    pos = qdf_content.find(b"/Subtype /Link")
+    while pos >= 0:
+        header_end = qdf_content.rfind(b" obj\n", 0, pos)
+        body_end = qdf_content.find(b"\nendobj\n", pos)
+        line_start = qdf_content.rfind(b"\n", 0, header_end) + 1
+        header = qdf_content[line_start:header_end].split()
+        # The header must belong to the object the match is in, and only plain
+        # dictionary objects (no streams) can be annotations.
+        if (
+            header_end >= 0
+            and body_end >= 0
+            and len(header) == 2
+            and header[0].isdigit()
+            and header[1].isdigit()
+            and qdf_content.rfind(b"\nendobj\n", 0, pos) < header_end
+        ):
+            if (
+                qdf_content.startswith(b">>\n", body_end - 2)
+                and qdf_content.find(b"/Type /Annot", header_end, body_end) >= 0
+            ):
+                ids.add((int(header[0]), int(header[1])))
+        pos = qdf_content.find(b"/Subtype /Link", pos + len(b"/Subtype /Link"))
+    return ids
+
+
+def shell_actions(flags):
+    """
+    Converts Inkscape long command line flags (--name or --name=value) into
+    their equivalent shell mode actions.
+    """
+    actions = []
+    for flag in flags:
+        if not flag.startswith("--") or ";" in flag:
+            raise Error("unsupported inkscape flag (use --name=value): %s" % flag)
+        name, sep, value = flag[2:].partition("=")
+        actions.append(name + ":" + value if sep else name)
+    return actions
 
-    # Load SVG
 
-    with open(input_svg_path) as f:
-        svg_content = f.read()
+def start_inkscape_shell(inkscape_path, input_svg_path, pdf_path, actions):
+    """
+    Starts a single Inkscape shell session that queries all objects and exports
+    the SVG as PDF to pdf_path, applying the extra actions to the export. The
+    session runs in the background until finish_inkscape_shell() is called.
+    """
+    commands = [
+        "file-open:" + input_svg_path,
+        "query-all",
+        "export-type:pdf",
+        "export-overwrite",
+        "export-filename:" + pdf_path,
+        *actions,
+        "export-do",
+        "quit",
+    ]
+    proc = Popen([inkscape_path, "--shell"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    proc.stdin.write("".join(c + "\n" for c in commands).encode("utf8"))
+    proc.stdin.flush()
+    return proc
+
+
+def finish_inkscape_shell(proc, pdf_path):
+    """
+    Waits for the Inkscape shell session started by start_inkscape_shell() to
+    end and returns its output containing the query results.
+    """
+    out, err = [v.decode("utf8") for v in proc.communicate()]
+    if "ERROR" in err or ("WARNING" not in err and proc.returncode != 0):
+        raise Error("inkscape: " + err)
+    if os.path.getsize(pdf_path) == 0:
+        raise Error("inkscape: PDF export failed " + err)
+    return out
+
+
+def load_svg(input_svg_path, px_to_pt):
+    """
+    Returns the pages of the SVG, with all measurements in points, and its
+    links as a dict of id -> href.
+    """
+
+    # Load SVG root attributes, pages and links in a single pass
+
+    svg_attrib = None
+    page_attribs = []
+    links = {}  # id -> href
+    try:
+        for _, elem in ET.iterparse(input_svg_path, events=("start",)):
+            if svg_attrib is None:
+                if elem.tag != _SVG_TAG:
+                    raise Error("%s is not an SVG document" % input_svg_path)
+                svg_attrib = elem.attrib
+            elif elem.tag == _PAGE_TAG:
+                page_attribs.append(dict(elem.attrib))
+                elem.clear()
+            elif elem.tag == _ANCHOR_TAG:
+                id = elem.get("id")
+                href = elem.get(_XLINK_HREF_ATTR) or elem.get("href")
+                if not href or not id:
+                    continue
+                links[id] = href
+    except ET.ParseError as e:
+        raise Error("cannot parse %s: %s" % (input_svg_path, e))
 
     # Get inkscape document scaling
 
@@ -57,43 +233,34 @@ def main():
         "in": 96,
     }
 
-    svg_tag = re.search(r"<svg[^>]*>", svg_content).group(0)
-    svg_width, svg_width_unit = re.search(
-        r'\bwidth\s*=\s*"([0-9.]+)(px|pt|mm|pc|cm|in)?"', svg_tag
-    ).groups()
+    svg_width, svg_width_unit = _SVG_LENGTH_RE.match(svg_attrib["width"]).groups()
     if not svg_width_unit:
         svg_width_unit = "px"
-    svg_height, svg_height_unit = re.search(
-        r'\bheight\s*=\s*"([0-9.]+)(px|pt|mm|pc|cm|in)?"', svg_tag
-    ).groups()
+    svg_height, svg_height_unit = _SVG_LENGTH_RE.match(svg_attrib["height"]).groups()
     if not svg_height_unit:
         svg_height_unit = "px"
     svg_viewbox_x, svg_viewbox_y, svg_viewbox_w, svg_viewbox_h = [
-        float(v)
-        for v in re.search(
-            r'\bviewBox\s*=\s*"\s*([0-9.]+)\s+([0-9.]+)\s+([0-9.]+)\s+([0-9.]+)"',
-            svg_tag,
-        ).groups()
+        float(v) for v in _SVG_VIEWBOX_RE.match(svg_attrib["viewBox"]).groups()
     ]
     svg_width_pixels = unit_2_px[svg_width_unit] * float(svg_width)
     svg_height_pixels = unit_2_px[svg_height_unit] * float(svg_height)
-    x_scale = svg_width_pixels / svg_viewbox_w
-    y_scale = svg_height_pixels / svg_viewbox_h
 
-    # Get pages and convert all measurements to pixels.
+    # All measurements are converted to PDF points upfront so that emitting
+    # links needs no further scaling.
+
+    x_scale = svg_width_pixels / svg_viewbox_w * px_to_pt
+    y_scale = svg_height_pixels / svg_viewbox_h * px_to_pt
+
+    # Get pages and convert all measurements to points.
 
     pages = {}
-    for pi, p in enumerate(re.findall(r"<inkscape:page\s+([^>]*)>", svg_content)):
-        x = re.search(r'\bx\s*=\s*"([^"]+)', p).group(1)
-        y = re.search(r'\by\s*=\s*"([^"]+)', p).group(1)
-        w = re.search(r'\bwidth\s*=\s*"([^"]+)', p).group(1)
-        h = re.search(r'\bheight\s*=\s*"([^"]+)', p).group(1)
+    for pi, p in enumerate(page_attribs):
         pages[pi + 1] = {
             "number": pi + 1,
-            "x": float(x) * x_scale,
-            "y": float(y) * y_scale,
-            "w": float(w) * x_scale,
-            "h": float(h) * y_scale,
+            "x": float(p["x"]) * x_scale,
+            "y": float(p["y"]) * y_scale,
+            "w": float(p["width"]) * x_scale,
+            "h": float(p["height"]) * y_scale,
         }
     if not pages:
         pages[1] = {
@@ -104,79 +271,87 @@ def main():
             "h": svg_viewbox_h * y_scale,
         }
 
-    # Get all objects
-
-    objects = {}
-    proc = Popen([inkscape_path, "-S", input_svg_path], stdout=PIPE, stderr=PIPE)
-    out, err = [v.decode("utf8") for v in proc.communicate()]
-    if "ERROR" in err or ("WARNING" not in err and proc.returncode != 0):
-        raise Error("inkscape: " + err)
-    for i in re.findall(
-        r"^([^,]+),([0-9.]+),([0-9.]+),([0-9.]+),([0-9.]+)$", out, re.MULTILINE
-    ):
-        objects[i[0]] = {
-            "id": i[0],
-            "x": float(i[1]),
-            "y": float(i[2]),
-            "w": float(i[3]),
-            "h": float(i[4]),
-            "page_locs": [],  # [{x,y,page}]
-        }
+    return pages, links
 
-    # Determine the local positions of objects on all the pages they are visible
-    # on.
 
-    for page in pages.values():
-        for obj in objects.values():
-            if intersected(page, obj):
-                obj["page_locs"].append(
-                    {
-                        "page": page["number"],
-                        "x": obj["x"] - page["x"],
-                        "y": obj["y"] - page["y"],
-                    }
-                )
+def main():
 
-    # Get all links
+    # Check requirements
 
-    anchors = re.findall(r"<a\s([^>]+)>", svg_content)
-    links = {}  # id -> href
-    for a in anchors:
-        id = re.search(r'\bid\s*=\s*"([^"]+)', a)
-        href = re.search(r'\bhref\s*=\s*"([^"]+)', a)
-        if not href or not id:
-            continue
-        id = id.group(1)
-        href = href.group(1).replace("(", "%28").replace(")", "%29")
-        links[id] = href
+    qpdf_path = shutil.which("qpdf")
+    if not qpdf_path:
+        raise Error("qpdf is missing - please install it before retrying")
+    inkscape_path = shutil.which("inkscape")
+    if not inkscape_path:
+        raise Error("inkscape is missing - please install it before retrying")
+    if len(sys.argv) < 3:
+        raise Error(
+            "Usage: %s input.svg output.pdf [--inkscape-flag[=value] ...]" % sys.argv[0]
+        )
+    input_svg_path, output_pdf_path, *inkscape_flags = sys.argv[1:]
+    if ";" in input_svg_path:
+        raise Error("input path can't contain ';' (Inkscape shell separator)")
 
-    # Export SVG as PDF using Inkscape
+    # Start querying all objects and exporting SVG as PDF using Inkscape in the
+    # background, while the SVG is being parsed.
 
     im_pdf = tempfile.NamedTemporaryFile(
         mode="rb", prefix="svglinkify-im-pdf-", suffix=".pdf", delete=True
     )
-    proc = Popen(
-        [
-            inkscape_path,
-            "--export-type=pdf",
-            "--export-overwrite",
-            "--export-filename",
-            im_pdf.name,
-            input_svg_path,
-            *inkscape_flags,
-        ],
-        stdout=PIPE,
-        stderr=PIPE,
+    inkscape = start_inkscape_shell(
+        inkscape_path, input_svg_path, im_pdf.name, shell_actions(inkscape_flags)
     )
-    _, err = [v.decode("utf8") for v in proc.communicate()]
-    if "ERROR" in err or ("WARNING" not in err and proc.returncode != 0):
-        raise Error("inkscape: " + err)
 
-    # QDFy the PDF so we can start modifying it
+    # Load the SVG while Inkscape is running. If that fails, Inkscape must be
+    # stopped before the intermediate PDF is cleaned up, or the export would
+    # recreate it.
+
+    px_to_pt = 0.75
+    try:
+        pages, links = load_svg(input_svg_path, px_to_pt)
+    except BaseException:
+        inkscape.kill()
+        inkscape.communicate()
+        raise
+
+    # Get all objects
+
+    objects = {}
+    for i in _QUERY_ROW_RE.findall(finish_inkscape_shell(inkscape, im_pdf.name)):
+        objects[i[0]] = {
+            "id": i[0],
+            "x": float(i[1]) * px_to_pt,
+            "y": float(i[2]) * px_to_pt,
+            "w": float(i[3]) * px_to_pt,
+            "h": float(i[4]) * px_to_pt,
+            "page_locs": [],  # [{page,y,rect}]
+            "best_page_loc": None,
+        }
+
+    # Determine the local positions of objects on all the pages they are visible
+    # on.
+
+    for obj, obj_pages in page_intersections(pages, objects.values()):
+        for page in obj_pages:
+            x = obj["x"] - page["x"]
+            y = obj["y"] - page["y"]
+            top = page["h"] - y
+            obj["page_locs"].append(
+                {
+                    "page": page["number"],
+                    "y": y,
+                    # Flipped to PDF coordinates: x1, y1 is the top left corner
+                    # and x2, y2 the bottom right one.
+                    "rect": (x, top, x + obj["w"], top - obj["h"]),
+                }
+            )
+        # As an object can appear on multiple pages, links to it go to the page
+        # where the y position of the object is the highest. This should make
+        # sense in most cases.
+        obj["best_page_loc"] = max(obj["page_locs"], key=lambda q: q["y"], default=None)
+
+    # QDFy the PDF and load it so we can start modifying it
 
-    qdf_tmp = tempfile.NamedTemporaryFile(
-        mode="r+b", prefix="svglinkify-qdf-", suffix=".pdf", delete=True
-    )
     proc = Popen(
         [
             qpdf_path,
@@ -185,56 +360,45 @@ def main():
             "--object-streams=disable",
             "--warning-exit-0",
             im_pdf.name,
-            qdf_tmp.name,
+            "-",
         ],
         stdout=PIPE,
         stderr=PIPE,
     )
-    _, err = proc.communicate()
+    qdf_content, err = proc.communicate()
     if proc.returncode != 0:
         raise Error(err.decode("utf8"))
 
-    # Load the QDFied PDF
-
-    qdf_tmp.seek(0)
-    qdf_content = qdf_tmp.read()
-
-    # Remove all existing links added by Inkscape
-
-    deleted_annots_object_ids = set()
-    for m in re.finditer(
-        rb"\n\n%%.*\n(\d+) (\d+) obj\n<<\n(?:^ .*\n)*>>\nendobj$",
-        qdf_content,
-        flags=re.MULTILINE,
-    ):
-        if b"/Type /Annot" in m.group(0) and b"/Subtype /Link" in m.group(0):
-            deleted_annots_object_ids.add((int(m.group(1)), int(m.group(2))))
-
-    # Get next object ID we can use.
-
-    next_object_id = int(
-        re.search(b"\n\nxref\n\d+ (\d+)$", qdf_content, re.MULTILINE).group(1)
-    )
-
-    # Load object IDs of all pages in the PDF document.
+    # Load object IDs and bodies of all pages in the PDF document.
 
     pdf_pages = {}
-
-    for m in re.finditer(
-        rb"^%% Page (\d+)\n%%[^\n]*\n(\d+)\s+(\d+)\s+obj\n.*?^endobj$",
-        qdf_content,
-        flags=(re.MULTILINE | re.DOTALL),
-    ):
+    for m in _QDF_PAGE_OBJ_RE.finditer(qdf_content):
         pdf_pages[int(m.group(1))] = {
             "obj_id": int(m.group(2)),
             "obj_gen": int(m.group(3)),
+            "body": m.group(4),
+            "body_span": m.span(4),
         }
 
+    # Find all existing links added by Inkscape so they can be removed.
+
+    deleted_annots_object_ids = link_annot_object_ids(qdf_content)
+
+    # Get next object ID we can use from the size of the trailing xref table
+    # (its first subsection line is "0 <size>").
+
+    xref_pos = qdf_content.rfind(b"\nxref\n") + 1
+    if xref_pos == 0:
+        raise Error("cannot find the xref table in the qdf output")
+    xref_size_start = xref_pos + len(b"xref\n")
+    xref_size_end = qdf_content.find(b"\n", xref_size_start)
+    next_object_id = int(qdf_content[xref_size_start:xref_size_end].split()[1])
+
     # Add links to the PDF
 
-    px_to_pt = 0.75
     pdf_page_annots = collections.defaultdict(list)  # page -> [annot_obj_id]
-    pdf_annot_objects = []
+    pdf_annot_objects = bytearray()
+    pdf_annot_offsets = []  # offsets of the objects in pdf_annot_objects
     for link_id, link_href in links.items():
         if link_id not in objects:
             continue
@@ -244,84 +408,93 @@ def main():
             if not target:
                 print("warn: link target not found: %s" % link_href, file=sys.stderr)
                 continue
-            # As an object can appear on multiple pages, pick the page where the
-            # y position of the target is the highest. This should make sense in
-            # most cases.
-            page_loc = max(target["page_locs"], key=lambda q: q["y"])
-            page = pages[page_loc["page"]]
-            pdf_page = pdf_pages[page["number"]]
+            page_loc = target["best_page_loc"]
+            if not page_loc:
+                print(
+                    "warn: link target not on any page: %s" % link_href,
+                    file=sys.stderr,
+                )
+                continue
+            pdf_page = pdf_pages[page_loc["page"]]
             action = b"/GoTo /D [ %d %d R /XYZ %f %f 0 ]" % (
                 pdf_page["obj_id"],
                 pdf_page["obj_gen"],
-                page_loc["x"] * px_to_pt,
-                (page["h"] - page_loc["y"]) * px_to_pt,
+                page_loc["rect"][0],
+                page_loc["rect"][1],
             )
         else:
-            action = b"/URI /URI (%s)" % link_href.encode("utf8")
-
-        link_object = objects[link_id]
-        for locs in link_object["page_locs"]:
-            page = pages[locs["page"]]
-            pdf_annot_objects.append(
-                b"\n%%QDF: ignore_newline\n"
-                b"%d 0 obj\n"
-                b"<<\n  /Type /Annot /Subtype /Link /Border [ 0 0 0 ]"
-                b" /A << /S %s >>"
-                b" /Rect [ %f %f %f %f ]\n>>\n"
-                b"endobj\n\n"
-                % (
-                    next_object_id,
-                    action,
-                    locs["x"] * px_to_pt,
-                    (page["h"] - locs["y"]) * px_to_pt,
-                    (locs["x"] + link_object["w"]) * px_to_pt,
-                    (page["h"] - locs["y"] - link_object["h"]) * px_to_pt,
-                )
+            uri = _URI_ESCAPE_RE.sub(
+                lambda m: _URI_ESCAPES[m.group()], link_href.encode("utf8")
             )
+            action = b"/URI /URI (%s)" % uri
+
+        annot_template = _ANNOT_OBJ_TEMPLATE.replace(b"%s", action.replace(b"%", b"%%"))
+        for locs in objects[link_id]["page_locs"]:
+            pdf_annot_offsets.append(len(pdf_annot_objects))
+            pdf_annot_objects += annot_template % (next_object_id, *locs["rect"])
             pdf_page_annots[locs["page"]].append(next_object_id)
             next_object_id += 1
 
-    def replace_annots_for_page(m):
-        page_number = int(m.group(1))
-        raw_annots = b""
-
-        def load_existing_annots(m):
-            raw_annots = m.group(1)
-
-        m = re.sub(rb"/Annots\s+\[([^\]]+)\]", load_existing_annots, m.group(0))
-        for obj_id, gen_id in deleted_annots_object_ids:
-            raw_annots = re.sub(rb"\b%d %d R" % (obj_id, gen_id), b"", raw_annots)
+    def page_body_with_annots(page_number, body):
+        annot_refs = []
+        m = _QDF_ANNOTS_RE.search(body)
+        if m:
+            body = body[: m.start()] + body[m.end() :]
+            for ref in _QDF_REF_RE.finditer(m.group(1)):
+                obj_id, gen_id = int(ref.group(1)), int(ref.group(2))
+                if (obj_id, gen_id) not in deleted_annots_object_ids:
+                    annot_refs.append(b"%d %d R" % (obj_id, gen_id))
         for obj_id in pdf_page_annots.get(page_number, []):
-            raw_annots += b"\n%d 0 R\n" % obj_id
-        raw_annots = raw_annots.strip()
-        if raw_annots:
-            return re.sub(
-                rb"^<<", rb"<<\n/Annots [ %s ]" % raw_annots, m, flags=re.MULTILINE
-            )
-        return m
-
-    qdf_content = re.sub(
-        rb"^%% Page (\d+)$.*?^endobj$",
-        replace_annots_for_page,
-        qdf_content,
-        flags=re.MULTILINE | re.DOTALL,
-    )
+            annot_refs.append(b"%d 0 R" % obj_id)
+        if annot_refs and body.startswith(b"<<"):
+            return b"<<\n/Annots [ %s ]" % b"\n".join(annot_refs) + body[2:]
+        return body
+
+    # Rebuild the QDF by copying it over with the page bodies replaced and the
+    # new annotation objects inserted right before the xref table. The xref
+    # table is rewritten as well so the QDF stays valid without fix-qdf:
+    # objects past a replaced page body are shifted by how much it grew.
+
+    qdf_view = memoryview(qdf_content)
+    new_qdf_content = bytearray()
+    shift_ends = []  # old end position of each replaced page body
+    shifts = []  # total shift of everything past the corresponding end
+    pos = 0
+    for page_number, pdf_page in pdf_pages.items():
+        start, end = pdf_page["body_span"]
+        new_qdf_content += qdf_view[pos:start]
+        new_qdf_content += page_body_with_annots(page_number, pdf_page["body"])
+        pos = end
+        shift_ends.append(end)
+        shifts.append(len(new_qdf_content) - end)
+    new_qdf_content += qdf_view[pos:xref_pos]
+    annots_pos = len(new_qdf_content)
+    new_qdf_content += pdf_annot_objects
+
+    new_xref_pos = len(new_qdf_content)
+    new_qdf_content += b"xref\n0 %d\n" % next_object_id
+    trailer_pos = qdf_content.find(b"trailer", xref_size_end)
+    entries = qdf_content[xref_size_end:trailer_pos].split()
+    for i in range(0, len(entries), 3):
+        offset, gen, kind = int(entries[i]), int(entries[i + 1]), entries[i + 2]
+        if kind == b"n":
+            shift_index = bisect.bisect_right(shift_ends, offset)
+            if shift_index:
+                offset += shifts[shift_index - 1]
+        new_qdf_content += b"%010d %05d %s \n" % (offset, gen, kind)
+    for offset in pdf_annot_offsets:
+        new_qdf_content += b"%010d 00000 n \n" % (annots_pos + offset)
+    trailer = qdf_content[trailer_pos : qdf_content.find(b"startxref", trailer_pos)]
+    new_qdf_content += _QDF_TRAILER_SIZE_RE.sub(b"/Size %d" % next_object_id, trailer)
+    new_qdf_content += b"startxref\n%d\n%%%%EOF\n" % new_xref_pos
+    qdf_content = new_qdf_content
+
+    # UnQDFy the PDF and save it. The QDF is already valid so it goes straight
+    # to qpdf, though through a file as qpdf cannot read its input from stdin.
 
-    qdf_content = re.sub(
-        rb"^xref$",
-        rb"%s\nxref" % b"".join(pdf_annot_objects),
-        qdf_content,
-        flags=re.MULTILINE,
+    qdf_tmp = tempfile.NamedTemporaryFile(
+        mode="wb", prefix="svglinkify-qdf-", suffix=".pdf", delete=True
     )
-
-    # UnQDFy the PDF and save it.
-
-    proc = Popen([fix_qdf_path], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    qdf_content, err = proc.communicate(qdf_content)
-    if proc.returncode != 0:
-        raise Error("cannot fix the qdf output " + err.decode("utf8"))
-
-    qdf_tmp.truncate()
     qdf_tmp.write(qdf_content)
     qdf_tmp.flush()
 